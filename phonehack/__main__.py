@@ -1,9 +1,10 @@
 import os
 import logging
 import asyncio
-import RPi.GPIO as GPIO
-from typing import Any, Callable, Coroutine, Dict
-from pygame import mixer
+import signal
+import wave
+from pathlib import Path
+from typing import Any, Callable, Coroutine, Dict, Optional
 
 
 # Configure logging
@@ -13,22 +14,24 @@ log = logging.getLogger(__name__)
 
 # Declare timeouts and intervals
 DEFAULT_SHELL_CMD_TIMEOUT_SECS = 5
-DEFAULT_GPIO_EVENT_POLL_SECS = 0.2
 DEFAULT_GPIO_EVENT_DEBOUNCE_SECS = 0.8
 RING_TOGGLE_INTERVAL_SECS = 0.05
 RING_DURATION_SECS = 1.6
+RING_PWM_FREQUENCY_HZ = 1.0 / (RING_TOGGLE_INTERVAL_SECS * 2)  # one HIGH/LOW cycle per two toggles
+AUDIO_PLAYBACK_POLL_SECS = 0.05
+AUDIO_PLAYBACK_MAX_SECS = 600
 
 # Declare GPIO pins
 PIN_OUT_RINGER = 11
 PIN_IN_HANGAR = 13
 
 # Declare paths
-MODULE_PATH = os.path.dirname(os.path.abspath(__file__))
-SOUNDS_PATH = os.path.join(MODULE_PATH, '..', 'sounds')
+MODULE_PATH = Path(__file__).resolve().parent
+SOUNDS_PATH = MODULE_PATH.parent / 'sounds'
 
-# Declare audio file manifest
+# Declare audio file manifest, keyed by uppercase file name e.g. "applause.wav" -> "APPLAUSE"
 SOUNDS_MANIFESET: Dict[str, str] = {
-    'APPLAUSE': os.path.join(SOUNDS_PATH, 'applause.wav'),
+    path.stem.upper(): str(path) for path in sorted(SOUNDS_PATH.glob('*.wav'))
 }
 
 # Declare valid audio outputs, "local" is the builtin 1/8" jack
@@ -37,16 +40,27 @@ AUDIO_OUTPUT_LOCAL = 'local'
 AUDIO_OUTPUT_ALL = 'both'
 AUDIO_OUTPUTS = frozenset([AUDIO_OUTPUT_HDMI, AUDIO_OUTPUT_LOCAL, AUDIO_OUTPUT_ALL])
 
+# RPi.GPIO and pygame.mixer modules, imported on demand by setup()
+GPIO: Any = None
+mixer: Any = None
+
+# Sounds decoded into memory from the manifest, loaded in setup()
+SOUNDS: Dict[str, Any] = {}
+
+# Software PWM driving the ringer coil, created in setup()
+_ringer_pwm: Optional[Any] = None
+
 
 async def async_cmd(cmd: str, timeout_secs: float = DEFAULT_SHELL_CMD_TIMEOUT_SECS) -> None:
     """
     Run a shell command async and handle stderr/stdout.
     """
-    log.debug(f'Executing async shell command "{cmd}"')
+    log.debug('Executing async shell command "%s"', cmd)
     process = await asyncio.create_subprocess_shell(
         cmd,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE,
+        start_new_session=True,  # own process group, so the shell's children can be killed
     )
     try:
         stdout, stderr = await asyncio.wait_for(
@@ -55,68 +69,152 @@ async def async_cmd(cmd: str, timeout_secs: float = DEFAULT_SHELL_CMD_TIMEOUT_SE
         )
     except asyncio.TimeoutError as e:
         raise Exception(f'Shell command "{cmd}" timed out') from e
+    finally:
+        # Kill the whole process group and reap the shell, so a timeout or
+        # cancellation can't leave the command (e.g. omxplayer.bin) running
+        if process.returncode is None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            await process.wait()
     if process.returncode != 0:
         err = stderr.decode('utf8')
         raise Exception(
             f'Shell command "{cmd}" exited with status {process.returncode}:\n{err}',
         )
-    output = stdout.decode('utf8')
-    log.debug(f'Shell command "{cmd}" successful with stdout:\n{output}')
+    if log.isEnabledFor(logging.DEBUG):
+        output = stdout.decode('utf8', 'replace')
+        log.debug('Shell command "%s" successful with stdout:\n%s', cmd, output)
 
 
-def play_audio_file(filepath: str, output: str = AUDIO_OUTPUT_LOCAL) -> Callable[[], Coroutine[Any, Any, None]]:
+def get_wav_duration_secs(filepath: str) -> float:
+    """
+    Read the duration of a WAV file from its header, or AUDIO_PLAYBACK_MAX_SECS if unreadable.
+    """
+    try:
+        with wave.open(filepath) as f:
+            return f.getnframes() / f.getframerate()
+    except (wave.Error, EOFError) as e:
+        # Before Python 3.12 wave only reads plain PCM, e.g. not WAVE_FORMAT_EXTENSIBLE
+        log.debug('Could not read duration of "%s": %s', filepath, e)
+        return AUDIO_PLAYBACK_MAX_SECS
+
+
+async def play_audio_file(filepath: str, output: str = AUDIO_OUTPUT_LOCAL) -> None:
     """
     Play an audio file from disk using omxplayer.
     """
-    log.debug(f'Playing audio file at path "{filepath}" to output "{output}"')
+    log.debug('Playing audio file at path "%s" to output "%s"', filepath, output)
     if output not in AUDIO_OUTPUTS:
         raise Exception(f'Audio output "{output}" invalid: must be one of {AUDIO_OUTPUTS}')
-    return async_cmd(f'omxplayer -o {output} "{filepath}"')
+
+    # Allow the full length of the recording on top of the usual command timeout
+    loop = asyncio.get_running_loop()
+    duration_secs = await loop.run_in_executor(None, get_wav_duration_secs, filepath)
+    await async_cmd(
+        f'omxplayer -o {output} "{filepath}"',
+        timeout_secs=duration_secs + DEFAULT_SHELL_CMD_TIMEOUT_SECS,
+    )
+
+
+async def play_sound(name: str) -> None:
+    """
+    Play a preloaded sound from the manifest and wait for playback to finish.
+    Falls back to omxplayer if the mixer could not be initialized.
+    """
+    if name not in SOUNDS:
+        await play_audio_file(SOUNDS_MANIFESET[name])
+        return
+
+    log.debug('Playing sound "%s"', name)
+    channel = SOUNDS[name].play()
+    if channel is None:
+        log.warning('No free mixer channel to play sound "%s"', name)
+        return
+    while channel.get_busy():
+        await asyncio.sleep(AUDIO_PLAYBACK_POLL_SECS)
+
+
+def _set_future_result(fut: asyncio.Future, result: Any) -> None:
+    """Resolve a future unless it was already resolved or cancelled."""
+    if not fut.done():
+        fut.set_result(result)
 
 
 def get_gpio_event_detector(
     pin: int,
     event: int,  # 0 (low) or 1 (high)
-    reusable: bool = False,
-    poll_interval_secs: float = DEFAULT_GPIO_EVENT_POLL_SECS,
     debounce_secs: float = DEFAULT_GPIO_EVENT_DEBOUNCE_SECS,
 ) -> Callable[[], Coroutine[Any, Any, int]]:
     """
     Return an awaitable function that resolves when a GPIO event is detected
     """
+    # Computed once per detector rather than on every await
+    event_name = 'HIGH' if event else 'LOW'
+
     async def _event_detector() -> int:
-        """Poll async until an event is detected"""
-        debounce_timer_secs: float = 0
-        event_name = 'HIGH' if event else 'LOW'
-        log.debug(f'Pin {pin} awaiting event {event_name}')
-
-        while True:
-            # Poll async for events: sleep until GPIO pin is in target state
-            if GPIO.input(pin) != event:
-                debounce_timer_secs = 0
-                await asyncio.sleep(poll_interval_secs)
-                continue
-
-            # If pin is in desired state, keep polling until debounce timer is met
-            if debounce_timer_secs < debounce_secs:
-                log.debug(
-                    f'Pin {pin} matched state {event_name} for {debounce_timer_secs} of {debounce_secs}s'
-                )
-                debounce_timer_secs += poll_interval_secs
-                continue
-
-            # Stop listening if this event detector is not reusable
-            if not reusable:
-                log.debug(f'Pin {pin} removing detector for event {event_name}')
-                GPIO.remove_event_detect(pin)
-
-            # Return the pin state, 0 (low) or 1 (high)
-            log.debug(f'Pin {pin} in state {event_name}')
-            return event
+        """Wait async for an edge interrupt until an event is detected"""
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        log.debug('Pin %s awaiting event %s', pin, event_name)
+
+        def _on_edge(channel: int) -> None:
+            # Called from the RPi.GPIO event thread: hand the event back to the loop
+            loop.call_soon_threadsafe(_set_future_result, fut, event)
+
+        # Let the kernel wake us on the edge. No bouncetime: it can drop the edge we
+        # need, and the sleep-and-reread below already debounces
+        edge = GPIO.RISING if event else GPIO.FALLING  # GPIO is only imported by setup()
+        GPIO.add_event_detect(pin, edge, callback=_on_edge)
+        try:
+            while True:
+                # Arm a fresh future for the next edge before reading the pin
+                if fut.done():
+                    fut = loop.create_future()
+
+                # No edge will fire if the pin is already in the target state
+                if GPIO.input(pin) != event:
+                    await fut
+                    continue
+
+                # Debounce once: pin must still be in target state after debounce_secs
+                log.debug('Pin %s matched state %s, debouncing %ss', pin, event_name, debounce_secs)
+                await asyncio.sleep(debounce_secs)
+                if GPIO.input(pin) == event:
+                    break
+        finally:
+            log.debug('Pin %s removing detector for event %s', pin, event_name)
+            GPIO.remove_event_detect(pin)
+
+        # Return the pin state, 0 (low) or 1 (high)
+        log.debug('Pin %s in state %s', pin, event_name)
+        return event
     return _event_detector
 
 
+async def load_sounds() -> None:
+    """
+    Decode every audio file in the manifest into memory, in parallel threads.
+    """
+    loop = asyncio.get_running_loop()
+    keys = list(SOUNDS_MANIFESET)
+    sounds = await asyncio.gather(*(
+        loop.run_in_executor(None, mixer.Sound, SOUNDS_MANIFESET[key]) for key in keys
+    ))
+    SOUNDS.update(zip(keys, sounds))
+
+
 async def setup() -> None:
+    global GPIO, mixer, _ringer_pwm
+
+    # Import hardware and audio libraries here rather than at module level:
+    # RPi.GPIO only loads on a RPI and pygame pulls in SDL, which is slow to import
+    import alsaaudio
+    import pygame
+    import RPi.GPIO as GPIO
+    from pygame import mixer
+
     # Use GPIO.BOARD mode for better portability
     # See https://sourceforge.net/p/raspberry-gpio-python/wiki/BasicUsage/
     GPIO.setmode(GPIO.BOARD)
@@ -126,38 +224,65 @@ async def setup() -> None:
     GPIO.setup(PIN_OUT_RINGER, GPIO.OUT, initial=GPIO.LOW)
     GPIO.setup(PIN_IN_HANGAR, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
 
+    _ringer_pwm = GPIO.PWM(PIN_OUT_RINGER, RING_PWM_FREQUENCY_HZ)
+
     # Initialize pygame mixer
     log.debug('Initializing Python audio mixer')
-    mixer.init()
+    try:
+        mixer.init()
+    except pygame.error as e:
+        log.warning('Audio mixer unavailable, falling back to omxplayer: %s', e)
+
+    # Unmute RPI and set volume in-process via the ALSA mixer API
+    log.debug('Unmuting RPI and setting RPI system volume 100%')
+    system_mixer = alsaaudio.Mixer('Headphone')
+    system_mixer.setmute(0)
+    system_mixer.setvolume(100)
+
+    # Decode sounds in worker threads to keep the event loop responsive
+    if mixer.get_init():
+        log.debug('Loading sounds')
+        await load_sounds()
+
 
-    # Unmute RPI at system level
-    log.debug('Unmuting RPI')
-    await async_cmd('amixer set Headphone unmute')
-    log.debug('Setting RPI system volume 100%')
-    await async_cmd('amixer set Headphone 100%')
+async def wait_for_event(event: asyncio.Event, timeout_secs: float) -> bool:
+    """
+    Wait up to timeout_secs for an asyncio event to be set. Return whether it was set.
+    """
+    try:
+        await asyncio.wait_for(event.wait(), timeout=timeout_secs)
+    except asyncio.TimeoutError:
+        pass
+    return event.is_set()
 
 
-async def ring_once() -> None:
+async def ring_once(stop: asyncio.Event) -> None:
     """
-    Rapidly toggle ringer output channel for RING_DURATION_SECS.
+    Toggle ringer output channel with PWM for RING_DURATION_SECS or until stop is set.
     """
-    ring_timer_secs: float = 0
+    assert _ringer_pwm, 'setup() must run before ringing'
 
     log.debug('Ring! Ring!')
-    while ring_timer_secs < RING_DURATION_SECS:
-        for v in (GPIO.HIGH, GPIO.LOW):
-            GPIO.output(PIN_OUT_RINGER, v)
-            ring_timer_secs += RING_TOGGLE_INTERVAL_SECS
-            await asyncio.sleep(RING_TOGGLE_INTERVAL_SECS)
+    # RPi.GPIO forgets the frequency on stop() and restarts at 1kHz, so set it every ring
+    _ringer_pwm.ChangeFrequency(RING_PWM_FREQUENCY_HZ)
+    _ringer_pwm.start(50)
+    try:
+        await wait_for_event(stop, RING_DURATION_SECS)
+    finally:
+        # Never leave the coil energized, however this ring ends
+        try:
+            _ringer_pwm.stop()
+        finally:
+            GPIO.output(PIN_OUT_RINGER, GPIO.LOW)
 
 
-async def ring_forever() -> None:
+async def ring_forever(stop: asyncio.Event) -> None:
     """
-    Ring the phone forever. Wrap in a task and use cancel() to stop ringer.
+    Ring the phone until stop is set.
     """
-    while True:
-        await ring_once()
-        await asyncio.sleep(RING_DURATION_SECS)
+    while not stop.is_set():
+        await ring_once(stop)
+        await wait_for_event(stop, RING_DURATION_SECS)
 
 
 async def ring_until_answered() -> None:
@@ -165,23 +290,36 @@ async def ring_until_answered() -> None:
     Ring forever until phone is removed from hook.
     """
     log.debug('Ringing...')
-    ring_forever_task = asyncio.create_task(ring_forever())
+    stop = asyncio.Event()
+    ring_forever_task = asyncio.create_task(ring_forever(stop))
+    is_answered = get_gpio_event_detector(PIN_IN_HANGAR, GPIO.HIGH)
+    is_answered_task = asyncio.create_task(is_answered())
 
-    def on_phone_answered(_: asyncio.Future) -> None:
+    try:
+        # Also wake if the ringer dies, so its error surfaces without waiting for an answer
+        await asyncio.wait(
+            {ring_forever_task, is_answered_task},
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+    finally:
+        # Signal the ringer and wait for both tasks to wind down before returning
         log.debug('Stopping ringer...')
-        ring_forever_task.cancel()
+        stop.set()
+        is_answered_task.cancel()
+        results = await asyncio.gather(
+            is_answered_task,
+            ring_forever_task,
+            return_exceptions=True,
+        )
+        # Re-raise the first real error only once both tasks have finished
+        for result in results:
+            if isinstance(result, Exception) and not isinstance(result, asyncio.CancelledError):
+                raise result
 
-    is_answered = get_gpio_event_detector(PIN_IN_HANGAR, GPIO.HIGH)
-    is_answered_task = asyncio.create_task(is_answered())
-    is_answered_task.add_done_callback(on_phone_answered)
-    await is_answered_task
     log.info('Phone answered')
 
 
-async def main() -> None:
-    log.info('Initializing')
-    await setup()
-
+async def run() -> None:
     is_in_hangar = get_gpio_event_detector(PIN_IN_HANGAR, GPIO.LOW)
 
     log.info('Starting loop')
@@ -193,13 +331,31 @@ async def main() -> None:
         await ring_until_answered()
 
         log.info('Starting audio playback')
-        await play_audio_file(SOUNDS_MANIFESET['APPLAUSE'])
+        await play_sound('APPLAUSE')
 
 
-if __name__ == '__main__':
+async def main() -> None:
+    # Cancel on SIGINT/SIGTERM so running tasks clean up before GPIO is released
+    loop = asyncio.get_running_loop()
+    main_task = asyncio.current_task()
+    assert main_task
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, main_task.cancel)
+
     try:
-        log.debug('Starting event loop')
-        asyncio.run(main())
+        log.info('Initializing')
+        await setup()
+        await run()
+    except asyncio.CancelledError:
+        log.info('Shutting down')
     finally:
         log.info('Cleaning up GPIO state before exit')
-        GPIO.cleanup()
+        if _ringer_pwm:  # ringer pin is only configured once setup() got this far
+            GPIO.output(PIN_OUT_RINGER, GPIO.LOW)
+        if GPIO:
+            GPIO.cleanup()
+
+
+if __name__ == '__main__':
+    log.debug('Starting event loop')
+    asyncio.run(main())